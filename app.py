@@ -1,22 +1,26 @@
 # app.py
 import os
 import io
+import contextlib
+import csv
 import time
 import smtplib
+import threading
+import logging
 from email.message import EmailMessage
+from textwrap import wrap
 from datetime import datetime
-from typing import Dict, List
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
 
 import streamlit as st
-import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 
 # -----------------------------
 # Config
 # -----------------------------
+log = logging.getLogger(__name__)
+
 st.set_page_config(page_title="AI Coach – Business Diagnostic", page_icon="🧭", layout="centered")
 
 APP_NAME = "AI Coach – Business Diagnostic"
@@ -31,6 +35,7 @@ SMTP_HOST = os.getenv("SMTP_HOST", "")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER", "")
 SMTP_PASS = os.getenv("SMTP_PASS", "")
+LEADS_PARQUET_DIR = os.getenv("LEADS_PARQUET_DIR", "")  # columnar lead store (needs pyarrow)
 
 # -----------------------------
 # Referral Tracking (UTM / ref)
@@ -55,15 +60,20 @@ def init_state():
         user_email="",
         user_name="",
         user_phone="",
-        referral=get_referral(),
         answers={},  # {"q_key": {"score": int, "note": str}}
         paid=False,
         report_pdf_bytes=None,
+        report_key=None,  # inputs the cached PDF was built from
         lead_id="",
+        email_job=None,  # Future of the last report email, if any
+        lead_row={},  # accumulated CRM row, written on report entry and on finish
     )
     for k, v in defaults.items():
         if k not in st.session_state:
             st.session_state[k] = v
+    # query params are fixed for the session; parse them only once
+    if "referral" not in st.session_state:
+        st.session_state["referral"] = get_referral()
 
 init_state()
 
@@ -81,20 +91,111 @@ QUESTIONS = [
     ("brand", "Brand & online presence"),
 ]
 
+QUESTION_LABELS = np.array([lbl for _, lbl in QUESTIONS])
+
+# Radar spoke directions, starting at 12 o'clock
+_angles = np.arange(len(QUESTIONS)) * (2 * np.pi / len(QUESTIONS)) - np.pi / 2
+SPOKE_COS, SPOKE_SIN = np.cos(_angles).tolist(), np.sin(_angles).tolist()
+
+ScoreKey = Tuple[Tuple[str, int], ...]
+
+def score_key(scores: Dict[str, Dict]) -> ScoreKey:
+    # hashable (key, score) pairs in QUESTIONS order, used as cache key
+    return tuple((k, scores[k]["score"]) for k, _ in QUESTIONS)
+
 # -----------------------------
 # Utils: Save to CSV (mock CRM)
 # -----------------------------
+ALL_COLUMNS = [
+    "lead_id", "name", "email", "phone", "paid", "created_utc", "updated_utc",
+    "ref", "utm_source", "utm_medium", "utm_campaign",
+    *[f"score_{k}" for k, _ in QUESTIONS],
+    "report_ready", "emailed", "completed_utc",
+]
+
+PARQUET_COMPACT_AT = 64  # small part files tolerated before merging them
+
+def write_leads_parquet(rows: List[Dict]):
+    # append-only dataset: each write lands in its own part file, and the
+    # parts are merged once they pile up so scans stay cheap
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"paid": pa.bool_(), "report_ready": pa.bool_(), "emailed": pa.bool_()}
+    types.update({f"score_{k}": pa.int8() for k, _ in QUESTIONS})
+    schema = pa.schema([(c, types.get(c, pa.string())) for c in ALL_COLUMNS])
+    table = pa.Table.from_pylist([{c: r.get(c) for c in ALL_COLUMNS} for r in rows], schema=schema)
+    os.makedirs(LEADS_PARQUET_DIR, exist_ok=True)
+    pq.write_table(table, os.path.join(LEADS_PARQUET_DIR, f"part-{time.time_ns()}.parquet"))
+
+    parts = sorted(
+        os.path.join(LEADS_PARQUET_DIR, f) for f in os.listdir(LEADS_PARQUET_DIR)
+        if f.startswith("part-") and f.endswith(".parquet")
+    )
+    if len(parts) >= PARQUET_COMPACT_AT:
+        merged = pa.concat_tables([pq.read_table(p, schema=schema) for p in parts])
+        # "_"-prefixed files are skipped by dataset readers until renamed
+        tmp = os.path.join(LEADS_PARQUET_DIR, "_compacting.parquet")
+        pq.write_table(merged, tmp)
+        os.replace(tmp, os.path.join(LEADS_PARQUET_DIR, f"part-{time.time_ns()}.parquet"))
+        for p in parts:
+            os.remove(p)
+
+def _prepare_csv() -> bool:
+    # Returns True when a header must be written. A file with any other
+    # header (e.g. the old pandas layout) is rotated aside, never appended to.
+    if not os.path.exists(CSV_DB):
+        return True
+    with open(CSV_DB, newline="", encoding="utf-8") as f:
+        header = next(csv.reader(f), [])
+    if header == ALL_COLUMNS:
+        return False
+    if header:
+        root, ext = os.path.splitext(CSV_DB)
+        rotated = f"{root}.{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}{ext}"
+        os.replace(CSV_DB, rotated)
+        log.warning("%s has a different header; moved it to %s", CSV_DB, rotated)
+    return True
+
+@st.cache_resource(show_spinner=False)
+def _lead_store() -> Tuple[threading.Lock, Dict[str, bool]]:
+    # process-wide: module globals are re-created on every Streamlit rerun
+    return threading.Lock(), {"csv_ready": False}
+
 def upsert_lead(row: Dict):
-    df = pd.DataFrame([row])
-    if os.path.exists(CSV_DB):
-        df0 = pd.read_csv(CSV_DB)
-        df = pd.concat([df0, df], ignore_index=True)
-    df.to_csv(CSV_DB, index=False)
+    lock, state = _lead_store()
+    with lock:
+        if LEADS_PARQUET_DIR:
+            write_leads_parquet([row])
+            return
+        # append-only; the header check runs once per process
+        new_file = not state["csv_ready"] and _prepare_csv()
+        with open(CSV_DB, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=ALL_COLUMNS, extrasaction="ignore")
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
+        state["csv_ready"] = True
+
+def flush_lead():
+    # write the accumulated session row, then reset it
+    row = st.session_state.get("lead_row")
+    if row:
+        upsert_lead(row)
+    st.session_state["lead_row"] = {}
 
 # -----------------------------
 # PDF Report Generation
 # -----------------------------
-def make_report_pdf(user_name: str, email: str, scores: Dict[str, Dict], insights: str) -> bytes:
+# short-lived and bounded: the PDF holds personal data, and per-session
+# reruns are served from st.session_state.report_pdf_bytes anyway
+@st.cache_data(show_spinner=False, ttl=600, max_entries=64)
+def make_report_pdf(user_name: str, email: str, score_items: ScoreKey, insights: str, generated_utc: str) -> bytes:
+    # imported lazily: only the report stage needs ReportLab
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    scores = dict(score_items)
     buf = io.BytesIO()
     c = canvas.Canvas(buf, pagesize=letter)
     w, h = letter
@@ -106,42 +207,36 @@ def make_report_pdf(user_name: str, email: str, scores: Dict[str, Dict], insight
     c.setFont("Helvetica", 11)
     c.drawString(72, h - 96, f"Name: {user_name}")
     c.drawString(72, h - 112, f"Email: {email}")
-    c.drawString(72, h - 128, f"Date: {datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')}")
+    c.drawString(72, h - 128, f"Date: {generated_utc}")
 
     # Scores table
     y = h - 160
     c.setFont("Helvetica-Bold", 12)
     c.drawString(72, y, "Compass Scores (1–5)")
     y -= 18
-    c.setFont("Helvetica", 10)
+    t = c.beginText(80, y)
+    t.setFont("Helvetica", 10, leading=14)
     for key, label in QUESTIONS:
-        sc = scores[key]["score"]
-        c.drawString(80, y, f"- {label}: {sc}")
-        y -= 14
+        t.textLine(f"- {label}: {scores[key]}")
+    c.drawText(t)
+    y = t.getY()
 
     # Insights
     y -= 10
     c.setFont("Helvetica-Bold", 12)
     c.drawString(72, y, "Milestones & Interpretation")
     y -= 16
-    c.setFont("Helvetica", 10)
 
     # Wrap insights text
-    wrap = []
-    line = ""
-    for word in insights.split():
-        if len(line) + len(word) + 1 < 90:
-            line += (" " if line else "") + word
-        else:
-            wrap.append(line)
-            line = word
-    if line:
-        wrap.append(line)
-    for l in wrap:
-        c.drawString(80, y, l)
-        y -= 13
-        if y < 72:
-            c.showPage(); y = h - 72
+    t = c.beginText(80, y)
+    t.setFont("Helvetica", 10, leading=13)
+    for l in wrap(insights, width=89):
+        t.textLine(l)
+        if t.getY() < 72:
+            c.drawText(t); c.showPage()
+            t = c.beginText(80, h - 72)
+            t.setFont("Helvetica", 10, leading=13)
+    c.drawText(t)
 
     # Simple spider chart (rendered separately & embedded is overkill for demo)
     c.showPage()
@@ -149,29 +244,25 @@ def make_report_pdf(user_name: str, email: str, scores: Dict[str, Dict], insight
     c.drawString(72, h - 72, "Compass Chart")
     # Draw a basic radar-like star by lines/points (schematic)
     cx, cy, R = 300, 400, 150
-    import math
     c.setFont("Helvetica", 9)
     # spokes
+    spoke_segments = []
     for i, (key, label) in enumerate(QUESTIONS):
-        angle = (2 * math.pi) * (i / len(QUESTIONS)) - math.pi / 2
-        x = cx + R * math.cos(angle)
-        y = cy + R * math.sin(angle)
-        c.line(cx, cy, x, y)
+        x = cx + R * SPOKE_COS[i]
+        y = cy + R * SPOKE_SIN[i]
+        spoke_segments.append((cx, cy, x, y))
         c.drawString(x + 4, y + 4, label[:16])
+    c.lines(spoke_segments)
     # polygon for scores
     pts = []
     for i, (key, label) in enumerate(QUESTIONS):
-        s = scores[key]["score"]
+        s = scores[key]
         r = (s / 5.0) * R
-        angle = (2 * math.pi) * (i / len(QUESTIONS)) - math.pi / 2
-        x = cx + r * math.cos(angle)
-        y = cy + r * math.sin(angle)
+        x = cx + r * SPOKE_COS[i]
+        y = cy + r * SPOKE_SIN[i]
         pts.append((x, y))
     # draw polygon
-    for i in range(len(pts)):
-        x1, y1 = pts[i]
-        x2, y2 = pts[(i + 1) % len(pts)]
-        c.line(x1, y1, x2, y2)
+    c.lines([(*pts[i], *pts[(i + 1) % len(pts)]) for i in range(len(pts))])
 
     c.showPage()
     c.save()
@@ -181,10 +272,12 @@ def make_report_pdf(user_name: str, email: str, scores: Dict[str, Dict], insight
 # -----------------------------
 # Insights Generation (rule-based for demo)
 # -----------------------------
-def interpret(scores: Dict[str, Dict]) -> str:
-    avg = np.mean([v["score"] for v in scores.values()])
-    low_areas = [label for (k, label) in QUESTIONS if scores[k]["score"] <= 2]
-    high_areas = [label for (k, label) in QUESTIONS if scores[k]["score"] >= 4]
+@st.cache_data(show_spinner=False, max_entries=256)
+def interpret(score_items: ScoreKey) -> str:
+    arr = np.fromiter((sc for _, sc in score_items), dtype=np.int8, count=len(score_items))
+    avg = arr.mean()
+    low_areas = QUESTION_LABELS[arr <= 2].tolist()
+    high_areas = QUESTION_LABELS[arr >= 4].tolist()
 
     lines = [
         f"Your overall readiness score is {avg:.1f}/5.",
@@ -207,9 +300,52 @@ def interpret(scores: Dict[str, Dict]) -> str:
 # -----------------------------
 # Email with PDF (optional)
 # -----------------------------
-def email_report(to_email: str, pdf_bytes: bytes, subject="Your Compass Report"):
+@st.cache_resource(show_spinner=False)
+def get_smtp() -> smtplib.SMTP:
+    s = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+    s.starttls()
+    s.login(SMTP_USER, SMTP_PASS)
+    return s
+
+@st.cache_resource(show_spinner=False)
+def _email_executor() -> ThreadPoolExecutor:
+    # one worker: sends run in order on the cached, non-thread-safe connection
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="email")
+
+def _smtp_alive(s: smtplib.SMTP) -> bool:
+    try:
+        return s.noop()[0] == 250
+    except smtplib.SMTPException:
+        return False
+
+def _reconnect_smtp(stale: smtplib.SMTP) -> smtplib.SMTP:
+    with contextlib.suppress(Exception):
+        stale.close()
+    get_smtp.clear()
+    return get_smtp()
+
+def _send_message(msg: EmailMessage):
+    # the cached connection may have been dropped while idle (often with a
+    # 421 reply rather than a disconnect): probe it and reconnect if needed
+    s = get_smtp()
+    if not _smtp_alive(s):
+        s = _reconnect_smtp(s)
+    try:
+        s.send_message(msg)
+    except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as e:
+        if getattr(e, "smtp_code", 421) != 421:
+            raise
+        _reconnect_smtp(s).send_message(msg)
+
+def _log_send_failure(job: Future):
+    if job.exception() is not None:
+        log.error("Report email failed: %s", job.exception())
+
+def email_report(to_email: str, pdf_bytes: bytes, subject="Your Compass Report") -> Tuple[Optional[Future], str]:
+    # Returns (job, error); job is None, with the reason in error, when
+    # nothing was queued. Check job.done()/job.exception() for delivery.
     if not (SMTP_HOST and SMTP_USER and SMTP_PASS):
-        return False, "Email not configured in demo."
+        return None, "Email not configured in demo."
     try:
         msg = EmailMessage()
         msg["From"] = SMTP_USER
@@ -217,13 +353,18 @@ def email_report(to_email: str, pdf_bytes: bytes, subject="Your Compass Report")
         msg["Subject"] = subject
         msg.set_content("Hi! Your Compass Report is attached.\n\nThank you.")
         msg.add_attachment(pdf_bytes, maintype="application", subtype="pdf", filename="Compass_Report.pdf")
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as s:
-            s.starttls()
-            s.login(SMTP_USER, SMTP_PASS)
-            s.send_message(msg)
-        return True, "Email sent."
+        job = _email_executor().submit(_send_message, msg)
+        job.add_done_callback(_log_send_failure)
+        return job, ""
     except Exception as e:
-        return False, f"Email failed: {e}"
+        return None, f"Email failed: {e}"
+
+def email_sent(job: Optional[Future], timeout: float = 0) -> bool:
+    # True only once the worker has actually delivered the message
+    if job is None:
+        return False
+    wait([job], timeout=timeout)
+    return job.done() and job.exception() is None
 
 # -----------------------------
 # UI: Landing
@@ -265,32 +406,34 @@ def ui_payment():
 # UI: Auth (demo)
 # -----------------------------
 def ui_auth():
+    s = st.session_state
     st.subheader("👤 Sign up / Log in")
     with st.form("auth_form"):
-        email = st.text_input("Email", value=st.session_state.user_email)
-        name = st.text_input("Full Name", value=st.session_state.user_name)
-        phone = st.text_input("Phone", value=st.session_state.user_phone)
+        email = st.text_input("Email", value=s.user_email)
+        name = st.text_input("Full Name", value=s.user_name)
+        phone = st.text_input("Phone", value=s.user_phone)
         password = st.text_input("Password", type="password")
         submit = st.form_submit_button("Continue")
     if submit:
         if not (email and name and password):
             st.error("Please fill email, name, and password.")
             return
-        st.session_state.user_email = email
-        st.session_state.user_name = name
-        st.session_state.user_phone = phone
-        st.session_state.lead_id = f"lead_{int(time.time())}"
-        # Upsert into mock CRM
-        upsert_lead({
-            "lead_id": st.session_state.lead_id,
+        lead_id = f"lead_{int(time.time())}"
+        s.user_email = email
+        s.user_name = name
+        s.user_phone = phone
+        s.lead_id = lead_id
+        # Stage lead for mock CRM (written on entering the report)
+        s["lead_row"].update({
+            "lead_id": lead_id,
             "name": name,
             "email": email,
             "phone": phone,
-            "paid": st.session_state.paid,
+            "paid": s.paid,
             "created_utc": datetime.utcnow().isoformat(),
-            **st.session_state["referral"],
+            **s["referral"],
         })
-        st.session_state.stage = "survey"
+        s.stage = "survey"
 
 # -----------------------------
 # UI: Survey / Chat-like Qs
@@ -314,56 +457,102 @@ def ui_survey():
         }
         for k, _ in QUESTIONS:
             row[f"score_{k}"] = responses[k]["score"]
-        upsert_lead(row)
+        st.session_state["lead_row"].update(row)
+        # persist the lead now, before the report is built, so a user who
+        # leaves on the report page is still recorded
+        flush_lead()
         st.session_state.stage = "report"
 
+@st.cache_data(show_spinner=False, max_entries=256)
+def build_scores_png(score_items: ScoreKey) -> bytes:
+    # a fresh Figure per render, off pyplot's shared state; only PNG bytes
+    # are cached, so sessions never share a mutable figure
+    from matplotlib.figure import Figure  # lazy: only the report stage plots
+
+    labels = [lbl for _, lbl in QUESTIONS]
+    vals = [sc for _, sc in score_items]
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.bar(labels, vals)
+    ax.tick_params(axis="x", labelrotation=45)
+    for tick in ax.get_xticklabels():
+        tick.set_ha("right")
+    ax.set_ylim(0, 5)
+    ax.set_title("Compass Scores")
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    return buf.getvalue()
+
 # -----------------------------
 # UI: Report + Email + Calendly
 # -----------------------------
+def _email_status():
+    job = st.session_state.email_job
+    if job is None:
+        return
+    if not job.done():
+        st.info("Sending your report…")
+    elif job.exception() is None:
+        st.success("Email sent.")
+    else:
+        st.error(f"Email failed: {job.exception()}")
+
+@st.fragment
+def _report_actions(pdf_bytes: bytes, email: str):
+    # reruns on its own, so clicks here skip the chart/PDF above
+    st.download_button("⬇️ Download PDF", data=pdf_bytes, file_name="Compass_Report.pdf", mime="application/pdf")
+    if st.button("📧 Email me the report"):
+        job, err = email_report(email, pdf_bytes)
+        st.session_state.email_job = job
+        if job is None:
+            st.info(err)
+        else:
+            st.rerun()  # full rerun, so ui_report starts the status poll
+
 def ui_report():
+    s = st.session_state
+    name, email, scores = s.user_name, s.user_email, s.answers
     st.subheader("📄 Your Compass Report")
-    scores = st.session_state.answers
-    insights = interpret(scores)
-    pdf_bytes = make_report_pdf(st.session_state.user_name, st.session_state.user_email, scores, insights)
-    st.session_state.report_pdf_bytes = pdf_bytes
+    key = score_key(scores)
+    report_key = (name, email, key)
+    pdf_bytes = s.report_pdf_bytes
+    if pdf_bytes is None or s.report_key != report_key:
+        generated_utc = datetime.utcnow().strftime('%Y-%m-%d %H:%M UTC')
+        pdf_bytes = make_report_pdf(name, email, key, interpret(key), generated_utc)
+        s.report_pdf_bytes = pdf_bytes
+        s.report_key = report_key
 
     # Show quick chart inline
-    labels = [lbl for _, lbl in QUESTIONS]
-    vals = [scores[k]["score"] for k, _ in QUESTIONS]
-    fig = plt.figure()
-    plt.bar(labels, vals)
-    plt.xticks(rotation=45, ha="right")
-    plt.ylim(0, 5)
-    plt.title("Compass Scores")
-    st.pyplot(fig)
+    st.image(build_scores_png(key), use_container_width=True)
 
     st.success("Report generated!")
-    st.download_button("⬇️ Download PDF", data=pdf_bytes, file_name="Compass_Report.pdf", mime="application/pdf")
-
-    sent = False
-    if st.button("📧 Email me the report"):
-        ok, msg = email_report(st.session_state.user_email, pdf_bytes)
-        st.info(msg)
-        sent = ok
+    _report_actions(pdf_bytes, email)
+    # poll only while a send is pending; run_every is re-read on full reruns
+    job = s.email_job
+    pending = job is not None and not job.done()
+    st.fragment(run_every=1 if pending else None)(_email_status)()
 
     st.markdown("---")
     st.write("Next step: book your **AI Coaching call**.")
     st.link_button("📅 Book on Calendly", CALENDLY_URL)
 
     if st.button("Finish"):
-        # store final row
-        upsert_lead({
-            "lead_id": st.session_state.lead_id,
+        # second row with the completion fields
+        lead_row = s["lead_row"]
+        lead_row.update({
+            "lead_id": s.lead_id,
             "report_ready": True,
-            "emailed": sent,
+            "emailed": email_sent(s.email_job, timeout=10),
             "completed_utc": datetime.utcnow().isoformat(),
         })
-        st.session_state.stage = "done"
+        flush_lead()
+        s.stage = "done"
 
 # -----------------------------
 # UI: Done
 # -----------------------------
 def ui_done():
+    flush_lead()  # no-op if already written on Finish
     st.header("✅ All set!")
     st.write("Thank you. Your responses were saved. We’ll see you on the call.")
     st.link_button("Return to Home", "#")